@@ -8,23 +8,29 @@ Description:
     This program is a web application for analyzing ancient IBD (Identity By Descent) data between a modern individual and ancient populations.
     Users can upload a modern individual file in 23andMe format to calculate IBD, which will be validated and processed if necessary.
     The application also allows users to manage (upload or delete) ancient individual BAM files. Related config file should be correctly modified.
-    After processing the input files, users can run the IBD calculation workflow using Snakemake. It also supports dry runs to preview the workflow without executing it. Number of cores can be set for the workflow.
+    After processing the input files, users can run the IBD calculation workflow using Snakemake. It also supports dry runs to preview the workflow without executing it. Number of cores and max threads per job can be set for the workflow.
     When the workflow is completed, the result will be displayed and can be downloaded as a TSV file.
 
 List of functions:
     1.validate_bam_file(): validate the user-uploaded BAM file.
-    check the file extension and use samtools to quickly validate the content.
+    check the file extension and the BGZF magic bytes and EOF block to quickly validate the content (like samtools quickcheck).
+    2.is_same_file(): check if the uploaded file is the same as the existing file by the size and the first and last bytes.
+    3.save_bam_file(): save the uploaded bam file in chunks unless the same file already exists, keeping count of the written bytes.
+    4.load_yaml(): load the yaml config file, cached across reruns until the file is modified.
+    5.load_anc_tsv(): load the config file for ancient individual samples, cached across reruns until the file is modified.
+    6.read_log_lines(): read the output of the running workflow line by line in a background thread and get the workflow progress.
+    7.load_result(): load the result report with the arrow csv reader, cached across reruns until the file is modified.
     
 Procedure:
     1. Preparation: check if the necessary directories exist and set up the streamlit web application with a title and description.
     2. Upload modern individual file: offer 2 choices for the user to upload a modern individual file:
     "Valid 23andMe input file with details: rsid, chromosome, position and genotype" which can directly upload and "Original 23andMe file needs processing" which needs validating and processing the file to be uploaded
-    with the script valid_23am.py.
-    3. Update ancient individual files: allow users to manage ancient individual BAM files, including uploading new files and deleting existing ones.
+    with validate_and_convert() from the script valid_23am.py.
+    3. Update ancient individual files: allow users to manage ancient individual BAM files, including uploading new files (several at once) and deleting existing ones.
     Users should also modify the related config file to specify the correct sample names and BAM file paths for the changed files.
     Only valid updates will be accepted.
     4. Run IBD calculating: provide options to run the IBD analysis workflow using Snakemake.
-    Users can choose to perform a dry run to preview the workflow or run it for real. The number of cores for the workflow can be set.
+    Users can choose to perform a dry run to preview the workflow or run it for real. The number of cores and max threads per job for the workflow can be set.
     5. Result: display the result of the IBD analysis, including a preview of the result report and a download option for the TSV file.
 
 Usage:
@@ -36,11 +42,37 @@ Usage:
 ############################################################################################################################################
 import streamlit as st
 import os
+import re
 import subprocess
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import pyarrow.csv as pacsv
 import yaml
 from pathlib import Path
-import tempfile
+from valid_23am import validate_and_convert
+# use the libyaml C bindings of PyYAML when they are available (installed with the yaml package in ibd_env.yml)
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
+
+# first 4 bytes of a BGZF compressed file and the empty BGZF block marking the end of a complete BAM file
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# chunk size for copying the uploaded files to disk (4 MiB)
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+# interval in seconds for refreshing the workflow log on the web page
+LOG_REFRESH_INTERVAL = 0.5
+# interval in seconds for refreshing the progress of writing uploaded bam files
+WRITE_PROGRESS_INTERVAL = 0.25
+# progress line printed by snakemake when a job is finished, eg. '3 of 10 steps (30%) done'
+SNAKEMAKE_PROGRESS_RE = re.compile(r'(\d+) of (\d+) steps \((\d+)%\) done')
+# number of bytes compared at the start and the end of files to check if an uploaded file already exists
+SAME_FILE_CHECK_SIZE = 4096
 
 def validate_bam_file(uploaded_file):
 
@@ -50,40 +82,93 @@ def validate_bam_file(uploaded_file):
             st.warning("file should end with .bam")
             return False
 
-        # use tempfile to create a temporary file for validation
-        with tempfile.NamedTemporaryFile(delete=True, suffix='.bam') as temp_file:
-            temp_path = temp_file.name
-            temp_file.write(uploaded_file.getbuffer())
-            temp_file.flush()
-
-            # validate the BAM file using samtools quickcheck
-            # if no samtools, just skip the check 
-            try:
-                result = subprocess.run(
-                    ["samtools", "quickcheck", temp_path], 
-                    capture_output=True, 
-                    text=True
-                )
-
-                if result.returncode == 0:
-                    return True
-                else:
-                    st.error("invalid bam file didn't pass the samtools check")
-                    return False
-            except FileNotFoundError:
-                st.warning("no samtools, still allow uploading but should be careful of bam file content")
-                return True
+        # check the BGZF magic bytes at the start and the BGZF EOF block at the end of the file in memory
+        # this is the fast part of samtools quickcheck, done without writing a temporary file and calling samtools
+        buf = uploaded_file.getbuffer()
+        if bytes(buf[:4]) == BGZF_MAGIC and bytes(buf[-28:]) == BGZF_EOF:
+            return True
+        else:
+            st.error("invalid bam file didn't pass the BGZF magic and EOF check")
+            return False
 
     except Exception as e:
         st.error(f"error in checking bam file: {str(e)}")
         return False
 
+# check if the uploaded file has the same content as the existing file by comparing the size and the first and last bytes
+# this is much cheaper than writing a bam file of several GB again
+def is_same_file(uploaded_file, path):
+    if not os.path.isfile(path):
+        return False
+    buf = uploaded_file.getbuffer()
+    file_size = os.path.getsize(path)
+    if file_size != len(buf):
+        return False
+    with open(path, 'rb') as f:
+        head = f.read(SAME_FILE_CHECK_SIZE)
+        f.seek(max(0, file_size - SAME_FILE_CHECK_SIZE))
+        tail = f.read()
+    return head == bytes(buf[:SAME_FILE_CHECK_SIZE]) and tail == bytes(buf[-SAME_FILE_CHECK_SIZE:])
+
+# save the uploaded bam file to the path, skip writing if the same file already exists
+# the number of bytes written so far is kept in written[0], so the progress can be shown while it runs in a worker thread
+# return True if the file is written. it doesn't call streamlit, so it can run in worker threads
+def save_bam_file(uploaded_file, path, written):
+    buf = uploaded_file.getbuffer()
+    if is_same_file(uploaded_file, path):
+        written[0] = len(buf)
+        return False
+    # write the bam file in chunks instead of writing the whole file at once
+    with open(path, "wb") as f:
+        for start in range(0, len(buf), COPY_CHUNK_SIZE):
+            f.write(buf[start:start + COPY_CHUNK_SIZE])
+            written[0] = min(start + COPY_CHUNK_SIZE, len(buf))
+    return True
+
+# cache the parsed config files across streamlit reruns, the modification time of the file is part of the cache key
+# so that the cache is refreshed when the file is changed outside the application
+# only the latest version of each file is kept, so old versions don't stay in memory
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_yaml(path, mtime):
+    with open(path, 'r') as file:
+        return yaml.load(file, Loader=YamlLoader) or {}
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_anc_tsv(path, mtime):
+    return pd.read_csv(path, sep='\t')
+
+# the result report is parsed by the multithreaded arrow csv reader and kept as arrow-backed columns,
+# which are also faster to send to the web page. only the latest report is kept in the cache
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_result(path, mtime):
+    return pacsv.read_csv(path, parse_options=pacsv.ParseOptions(delimiter='\t')).to_pandas(types_mapper=pd.ArrowDtype)
+
+# read the log lines of the running workflow in a background thread, count them and get the progress of the workflow
+# from the snakemake lines like "3 of 10 steps (30%) done"
+def read_log_lines(stream, logs, log_state):
+    for line in stream:
+        logs.append(line.strip())
+        log_state['lines'] += 1
+        match = SNAKEMAKE_PROGRESS_RE.search(line)
+        if match:
+            log_state['percent'] = int(match.group(3))
+    stream.close()
+
 #check the original directory structure and make sure the required folders exist in the current working directory
-if not os.path.exists("resources/testind") or not os.path.exists("config") or not os.path.exists("resources/anc_bam"):
-    st.error("❌ ERROR: lack required directory structure!")
-    st.error("Make sure you are running in the correct working directory")
-    st.error("basic directory needed：'resources/testind' and 'config' and 'resources/anc_bam'")
-    st.stop() 
+#the check is done once per session with 2 directory scans, not on every rerun
+if not st.session_state.get('dirs_ok'):
+    with os.scandir(".") as entries:
+        top_dirs = {e.name for e in entries if e.is_dir()}
+    resources_dirs = set()
+    if "resources" in top_dirs:
+        with os.scandir("resources") as entries:
+            resources_dirs = {e.name for e in entries if e.is_dir()}
+    if "config" not in top_dirs or not {"testind", "anc_bam"} <= resources_dirs:
+        st.error("❌ ERROR: lack required directory structure!")
+        st.error("Make sure you are running in the correct working directory")
+        st.error("basic directory needed：'resources/testind' and 'config' and 'resources/anc_bam'")
+        st.stop() 
+    st.session_state['dirs_ok'] = True
 
 st.set_page_config(
     page_title="Ancient IBD Calculation Workflow",
@@ -118,9 +203,16 @@ validated_file_path = None
 if uploaded_file is not None:
     filename = uploaded_file.name
     temp_file_path = f"resources/testind/temp_{filename}"
+    # the original format is saved to a temp file to be processed, the valid format is directly saved to the final file name
+    saved_file_path = temp_file_path if file_type == "Original 23andMe file needs processing" else f"resources/testind/{filename}"
 
-    with open(temp_file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    # streamlit reruns the whole script on every interaction with the same uploaded file,
+    # only write the file again when a new file is uploaded or the saved file is missing
+    if st.session_state.get('last_uploaded_id') != uploaded_file.file_id or not os.path.exists(saved_file_path):
+        with open(saved_file_path, "wb") as f:
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, f, length=COPY_CHUNK_SIZE)
+        st.session_state['last_uploaded_id'] = uploaded_file.file_id
     
     st.success(f"✅ file has been uploaded: {filename}")
     # when user chooses the original 23andMe file format, it needs to be validated and processed
@@ -129,22 +221,21 @@ if uploaded_file is not None:
         processed_filename = f"{Path(filename).stem}_processed.txt"
         validated_file_path = f"resources/testind/{processed_filename}"
         
-        # use the script valid_23am.py to validate and process the file
+        # use validate_and_convert() from valid_23am.py to validate and process the file in the same process
         try:
-            
-            process = subprocess.run(
-                ["python", "valid_23am.py", temp_file_path, validated_file_path],
-                capture_output=True,
-                text=True
-            )
-            # check the return code and output different corresponding messages for successful and failed upload
-            if process.returncode == 0:
+            # skip processing again if this uploaded file has already been processed successfully
+            if st.session_state.get('processed_for_id') == uploaded_file.file_id and os.path.exists(validated_file_path):
+                ok, error_msg = True, ""
+            else:
+                ok, error_msg = validate_and_convert(temp_file_path, validated_file_path)
+            # check the result and output different corresponding messages for successful and failed upload
+            if ok:
+                st.session_state['processed_for_id'] = uploaded_file.file_id
                 st.success(f"✅ file has been sucessfully processed and saved: {processed_filename}")
                 modern_file_path = validated_file_path
                 mdsample = Path(processed_filename).stem
             else:
                 st.error("❌ file format validation failed")
-                error_msg = process.stderr if process.stderr else process.stdout
                 st.error(f"error message as followed：\n{error_msg}")
                 
                 # offer the option to download the original file for modification
@@ -159,10 +250,7 @@ if uploaded_file is not None:
             st.error(f"error occurred while processing the original modern individual input file: {str(e)}")
     # when user chooses the valid 23andMe input file format, it can be directly uploaded
     else:
-        modern_file_path = f"resources/testind/{filename}"
-        # rename the temp file to the final file name
-        if os.path.exists(temp_file_path):
-            os.rename(temp_file_path, modern_file_path)
+        modern_file_path = saved_file_path
         mdsample = Path(filename).stem
         st.info(f"📄 file saved: {modern_file_path}")
     
@@ -170,16 +258,17 @@ if uploaded_file is not None:
     if modern_file_path and mdsample:
         config_path = "config/config.yaml"
         if os.path.exists(config_path):
-            with open(config_path, 'r') as file:
-                config = yaml.safe_load(file) or {}
+            config = load_yaml(config_path, os.path.getmtime(config_path))
         else:
             config = {}
         
-        config['modern_sample'] = modern_file_path        
-        with open(config_path, 'w') as file:
-            yaml.dump(config, file)
-        
-        st.success("✅ config updated!")
+        # only rewrite the config file when the modern sample is changed, so the cached config stays valid across reruns
+        if config.get('modern_sample') != modern_file_path:
+            config['modern_sample'] = modern_file_path
+            with open(config_path, 'w') as file:
+                yaml.dump(config, file, Dumper=YamlDumper, default_flow_style=False)
+            load_yaml.clear()
+            st.success("✅ config updated!")
 
 # manage ancient individual files (this part is not recommended as it'll take a long time to process the updated files even only 1 ancient file changed. it's a challenge for patience.)
 # (more importantly, if there's really a need to change the ancient individual files, it's more effienct to update the BAM files the related config file directly instead of doing it on the web.)
@@ -189,7 +278,7 @@ show_ancient_management = st.checkbox("I need to change the Ancient Individuals
 if show_ancient_management:
     anc_samples_path = "config/anc_samples.tsv"
     # load the existing ancient individual sample related config file
-    ancient_df = pd.read_csv(anc_samples_path, sep='\t')
+    ancient_df = load_anc_tsv(anc_samples_path, os.path.getmtime(anc_samples_path))
     
     st.subheader("edit anc_samples.tsv (recording ancient individual sample name and related file path")    
     # create a data editor for the ancient individual sample config file
@@ -199,82 +288,117 @@ if show_ancient_management:
     # only update this config file if the format is correct
     if not edited_df.equals(ancient_df):
         
-        format_error = False
         # check the sample path is provided in the edited table and starts with fixed format 'resources/anc_bam/' and ends with '.bam'
-        for idx, row in edited_df.iterrows():
-            if row['bam'] is None or pd.isna(row['bam']):
+        # the whole column is checked at once, only the rows with errors are looped through to show the messages
+        bam_empty = edited_df['bam'].isna()
+        bam_str = edited_df['bam'].fillna('').astype(str)
+        bam_ok = bam_str.str.startswith('resources/anc_bam/') & bam_str.str.endswith('.bam')
+        for idx in edited_df.index[~bam_ok]:
+            if bam_empty[idx]:
                 st.info(f"❌ the {idx+1} row: bam file path is empty, it should start with 'resources/anc_bam/'")
-                format_error = True
-            elif not row['bam'].startswith('resources/anc_bam/') or not row['bam'].endswith('.bam'):
+            else:
                 st.info(f"❌ the {idx+1} row: bam file path should start with 'resources/anc_bam/' and end with '.bam'")
-                format_error = True
+        format_error = not bam_ok.all()
   
         if not format_error:
             if st.button("table change saved"):
                 edited_df.to_csv(anc_samples_path, sep='\t', index=False)
+                load_anc_tsv.clear()
                 st.success("✅ anc_samples.tsv has been updated")
                 st.rerun()
     
     st.subheader("upload ancient individual bam file")
 
-    # file_uploader for the ancient individual BAM file
-    uploaded_bam = st.file_uploader("choose the ancient individual bam file to upload", type=['bam'])
+    # file_uploader for the ancient individual BAM files, several files can be uploaded at once
+    uploaded_bams = st.file_uploader("choose the ancient individual bam files to upload", type=['bam'], accept_multiple_files=True)
 
 
-    if uploaded_bam is not None:
-        st.session_state['uploaded_bam'] = uploaded_bam
-        uploaded_sample_id = os.path.basename(uploaded_bam.name).split('.')[0]
-        
-        # validate the uploaded BAM file
-        if validate_bam_file(uploaded_bam):
-
-            # show the upload-sample name selector for user to double check the file to be uploaded is for the expected sample, aslo check the update for the config file for ancient individual samples is correct
-            # the selector will list all the sample names got from the edited dataframe (the config file for ancient individual samples)
-            # user should select the sample name from selector that matches the uploaded BAM file name, or error message will be shown. this is based on the assumption that the sample name in the config file matches the BAM file name 
-            # this will avoid the situation that user upload a BAM file but there's something wrong with the update for the related congig file          
-            selected_sample = st.selectbox(
-                "select sample file name", 
-                edited_df['sample_name'].tolist(), # get the sample names from the edited dataframe
-                key=f"sample_selector_{uploaded_bam.name}"  # use unique key for each file uploader
-            )
-            
-            # check if the selected sample name from the selector matches the uploaded BAM file name
-            names_match = selected_sample == uploaded_sample_id
-            
-            if not names_match:
-                st.error(f"❌ selected sample name '{selected_sample}' isn't equal to '{uploaded_sample_id}'")
-                st.warning("Please select the matching sample name or upload the correct BAM file")
-            
-            selected_row = edited_df[edited_df['sample_name'] == selected_sample].iloc[0]
-            bam_path = selected_row['bam']
+    if uploaded_bams:
+        st.session_state['uploaded_bams'] = uploaded_bams
+        bams_to_save = [] # (uploaded file, bam path) of the files ready to be saved
+        assigned_paths = set() # each bam path can only be written by one uploaded file, or parallel writes would mix them up
+
+        for uploaded_bam in uploaded_bams:
+            st.write(f"file: {uploaded_bam.name}")
+            uploaded_sample_id = os.path.basename(uploaded_bam.name).split('.')[0]
             
-            # show the upload button for the BAM file in case the sample name matches
-            if names_match:
-                if st.button("ready to upload"):
-                    if not bam_path.startswith('resources/anc_bam/'):
-                        st.error("❌ bam file starts with 'resources/anc_bam/'?")
+            # validate the uploaded BAM file
+            if validate_bam_file(uploaded_bam):
+
+                # show the upload-sample name selector for user to double check the file to be uploaded is for the expected sample, aslo check the update for the config file for ancient individual samples is correct
+                # the selector will list all the sample names got from the edited dataframe (the config file for ancient individual samples)
+                # user should select the sample name from selector that matches the uploaded BAM file name, or error message will be shown. this is based on the assumption that the sample name in the config file matches the BAM file name 
+                # this will avoid the situation that user upload a BAM file but there's something wrong with the update for the related congig file          
+                selected_sample = st.selectbox(
+                    "select sample file name", 
+                    edited_df['sample_name'].tolist(), # get the sample names from the edited dataframe
+                    key=f"sample_selector_{uploaded_bam.file_id}"  # use unique key for each uploaded file, files can share a name
+                )
+                
+                # check if the selected sample name from the selector matches the uploaded BAM file name
+                names_match = selected_sample == uploaded_sample_id
+                
+                if not names_match:
+                    st.error(f"❌ selected sample name '{selected_sample}' isn't equal to '{uploaded_sample_id}'")
+                    st.warning("Please select the matching sample name or upload the correct BAM file")
+                    continue
+                
+                selected_row = edited_df[edited_df['sample_name'] == selected_sample].iloc[0]
+                bam_path = selected_row['bam']
+                if not bam_path.startswith('resources/anc_bam/'):
+                    st.error("❌ bam file starts with 'resources/anc_bam/'?")
+                elif os.path.normpath(bam_path) in assigned_paths:
+                    st.error(f"❌ another uploaded file is already saved to '{bam_path}', upload only one bam file for sample '{selected_sample}'")
+                else:
+                    assigned_paths.add(os.path.normpath(bam_path))
+                    bams_to_save.append((uploaded_bam, bam_path))
+            else:
+                st.error(f"❌ invalid bam file: {uploaded_bam.name}")
+
+        # show the upload button for the BAM files in case the sample names match
+        # the files are written in parallel threads as writing is limited by the disk, not by python
+        # the script thread only polls the written bytes to update the progress bar, so the web page stays responsive
+        if bams_to_save:
+            if st.button("ready to upload"):
+                for uploaded_bam, bam_path in bams_to_save:
+                    os.makedirs(os.path.dirname(bam_path), exist_ok=True)
+                written = [[0] for _ in bams_to_save]
+                total_size = max(1, sum(uploaded_bam.size for uploaded_bam, bam_path in bams_to_save))
+                write_progress = st.progress(0.0, text="writing bam files...")
+                with ThreadPoolExecutor(max_workers=min(8, len(bams_to_save))) as executor:
+                    futures = [executor.submit(save_bam_file, uploaded_bam, bam_path, bam_written)
+                               for (uploaded_bam, bam_path), bam_written in zip(bams_to_save, written)]
+                    while not all(future.done() for future in futures):
+                        write_progress.progress(min(1.0, sum(i[0] for i in written) / total_size), text="writing bam files...")
+                        time.sleep(WRITE_PROGRESS_INTERVAL)
+                    saved = [future.result() for future in futures]
+                write_progress.progress(1.0, text="bam files written")
+
+                for (uploaded_bam, bam_path), was_saved in zip(bams_to_save, saved):
+                    if was_saved:
+                        st.success(f"✅ bam file saved: {bam_path}")
                     else:
-                        os.makedirs(os.path.dirname(bam_path), exist_ok=True)
-                        
-                        with open(bam_path, "wb") as f:
-                            f.write(uploaded_bam.getbuffer())
-                        
-                        st.success("✅ bam file saved")
-                        st.rerun()
-        else:
-            st.error("❌ invalid bam file")
+                        st.info(f"identical bam file already exists, skip writing: {bam_path}")
+                if any(saved):
+                    st.rerun()
 
     # BAM file management list 
     st.subheader("List of uploaded bam files")
-    for idx, row in edited_df.iterrows():
-        sample_name = row['sample_name']
-        bam_path = row['bam']
-        
-        # skip invalid paths for bam files 
-        if bam_path is None or pd.isna(bam_path) or not bam_path.startswith('resources/anc_bam/'):
-            continue
-        
-        bam_exists = os.path.exists(bam_path)
+    # skip invalid paths for bam files, the rows are filtered at once and only the listed rows are looped through
+    listed_df = edited_df[edited_df['bam'].fillna('').astype(str).str.startswith('resources/anc_bam/')]
+    # get the size of all files in resources/anc_bam with a single directory scan instead of 2 stat calls for each row
+    # the folder is only checked once per session at the start, so it may have been removed since then
+    bam_stats = {}
+    if os.path.isdir("resources/anc_bam"):
+        with os.scandir("resources/anc_bam") as entries:
+            bam_stats = {os.path.normpath(e.path): e.stat() for e in entries if e.is_file()}
+    for idx, sample_name, bam_path in zip(listed_df.index, listed_df['sample_name'], listed_df['bam']):
+        bam_key = os.path.normpath(bam_path)
+        if os.path.dirname(bam_key) == os.path.normpath("resources/anc_bam"):
+            bam_stat = bam_stats.get(bam_key)
+        else: # bam files in subfolders are not covered by the scan
+            bam_stat = os.stat(bam_key) if os.path.isfile(bam_key) else None
+        bam_exists = bam_stat is not None
         
         col1, col2 = st.columns([3, 1])
         with col1:
@@ -282,7 +406,7 @@ if show_ancient_management:
             st.write(f"path: {bam_path}")
             
             if bam_exists:
-                file_size = os.path.getsize(bam_path) / (1024 * 1024)  # convert the filesize to MB
+                file_size = bam_stat.st_size / (1024 * 1024)  # convert the filesize to MB
                 st.info(f"file size: {file_size:.2f} MB")
             else:
                 st.warning("⚠️ bam file doesn't exist")
@@ -302,6 +426,26 @@ st.header("3. Run IBD calculating")
 
 # user can choose the number of cores for running the workflow
 cores = st.slider("choose cores for running", min_value=4, max_value=256, value=64, step=4)
+# --cores is the total budget for all jobs running at the same time, --max-threads caps the threads of a single job
+max_threads = st.slider("choose max threads per job", min_value=1, max_value=cores, value=min(32, cores),
+                        help="rules asking for more threads than this are scaled down to it")
+
+# large workflows (many ancient individuals) can be split into batches of the final rule 'all' that are run one after another
+batch_col1, batch_col2 = st.columns(2)
+with batch_col1:
+    batch_total = st.number_input("number of DAG batches (0 disables batching)", min_value=0, max_value=100, value=0)
+with batch_col2:
+    batch_index = st.number_input("DAG batch to run", min_value=1, max_value=max(1, batch_total), value=1, disabled=batch_total == 0)
+
+# common snakemake options for dry run and real run, keep going with independent jobs when one job fails
+# the greedy scheduler selects the jobs to run faster than the default ILP scheduler for workflows with many jobs
+# the rate limits only throttle job submission and status checks when running on a cluster or cloud executor,
+# they don't change local runs
+snakemake_options = ["--cores", str(cores), "--max-threads", str(max_threads), "--keep-going", "--rerun-triggers", "mtime",
+                     "--rerun-incomplete", "--scheduler", "greedy",
+                     "--max-jobs-per-second", "20", "--max-status-checks-per-second", "20"]
+if batch_total > 0:
+    snakemake_options += ["--batch", f"all={batch_index}/{batch_total}"]
 
 col1, col2 = st.columns(2)
 
@@ -315,7 +459,7 @@ with col2:
 if dry_run and mdsample:
     st.subheader("dry run output")
     with st.spinner("doing dry run..."):
-        cmd = ["snakemake", "--dry-run", "--rerun-triggers", "mtime"]
+        cmd = ["snakemake", "--dry-run"] + snakemake_options
         result = subprocess.run(cmd, capture_output=True, text=True)
         st.code(result.stdout)
         if result.stderr:
@@ -328,47 +472,54 @@ if run_actual and mdsample:
     status = st.empty()
     
     status.info("starting workflow running...")
-    progress_bar.progress(10)
     
     log_area = st.empty()
     
     process = subprocess.Popen(
-        ["snakemake", "--cores", str(cores), "--rerun-triggers", "mtime"],
+        ["snakemake"] + snakemake_options,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         text=True,
         bufsize=1
     )
     
-    logs = []
+    # the output of snakemake is drained by a background thread, so the pipe never blocks the workflow
+    # the web page is only refreshed every LOG_REFRESH_INTERVAL seconds instead of on every log line
+    logs = deque(maxlen=20) # keep the last 20 lines of the log to show
+    log_state = {'lines': 0, 'percent': 0}
+    reader = threading.Thread(target=read_log_lines, args=(process.stdout, logs, log_state), daemon=True)
+    reader.start()
 
-    progress = 10
-    
-    while True:
-        output = process.stdout.readline()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            logs.append(output.strip())
-            log_area.code('\n'.join(logs[-20:])) # show the last 20 lines of the log
-            
-            if progress < 90:
-                progress += 0.5
-                progress_bar.progress(min(int(progress), 90))
-            
+    shown_count = 0
+    shown_percent = 0
+
+    while reader.is_alive() or shown_count != log_state['lines']:
+        reader.join(timeout=LOG_REFRESH_INTERVAL)
+        if shown_count != log_state['lines']:
+            shown_count = log_state['lines']
+            log_area.code('\n'.join(list(logs)))
+
+        # only update the progress bar when snakemake reports more finished steps
+        if shown_percent != log_state['percent']:
+            shown_percent = log_state['percent']
+            progress_bar.progress(shown_percent)
+
+    process.wait()
     progress_bar.progress(100)
     
     return_code = process.poll()
     
     if return_code == 0:
         status.success("✅ workflow completed!")
+        # the workflow rewrites the result report, drop the cached old version
+        load_result.clear()
         
         # show the result
         st.header("4. Result!")
         result_file = f"results/06_ibd/processed_ibd_report_{mdsample}.tsv"
         
         if os.path.exists(result_file):
-            df = pd.read_csv(result_file, sep='\t')
+            df = load_result(result_file, os.path.getmtime(result_file))
             st.success(f"✅ result report found: {result_file}")
             
             st.subheader("report preview")
@@ -392,7 +543,7 @@ if not (dry_run or run_actual) and mdsample:
     result_file = f"results/06_ibd/processed_ibd_report_{mdsample}.tsv"
     if os.path.exists(result_file):
         st.header("4. Result")
-        df = pd.read_csv(result_file, sep='\t')
+        df = load_result(result_file, os.path.getmtime(result_file))
         st.success(f"✅ Found existed result: {result_file}")
         
         st.subheader("result preview")
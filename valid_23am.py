@@ -15,6 +15,8 @@ List of functions:
     1.valid_chromosome(): check the chromosome detail is only 'X', 'Y', 'XY', 'MT' or number between 0-26
     2.valid_position(): check the position detail is integer
     3.valid_genotype(): check the characters in genotype details only include 'A','C','T','G','D','I','-', or '0'
+    4.convert_23am(): check the content of the input file and convert it into the output file with uniform format
+    5.validate_and_convert(): validate and convert the input file, return whether it succeeded and the error message, used by app.py
             
 Procedure:
     1. Check the input arguments are valid and pass them as input file path and output file path.
@@ -23,6 +25,7 @@ Procedure:
 
 Usage:
     python valid_23am.py input_file output_file
+    or in python: from valid_23am import validate_and_convert; ok, error_msg = validate_and_convert(input_file, output_file)
 """
 ############################################################################################################################################
 
@@ -31,92 +34,110 @@ from pathlib import Path
 import re
 import csv
 
+#accepted values for the checks, compiled once so that each check is a single call into C
+CHROM_NAMES = frozenset(('X', 'Y', 'XY', 'MT'))
+#integers in the same form as accepted by int(): optional whitespace and sign around the digits
+INT_RE = re.compile(r'\s*[+-]?\d+\s*')
+GENO_RE = re.compile(r'[ACTGDI0-]*')
+
 #check the chromosome detail is only 'X', 'Y', 'XY', 'MT' or integer number between 0-26
 def valid_chromosome(chrom):
-    try:
-        if chrom.upper() in ['X', 'Y', 'XY','MT'] or 0 <= int(chrom) <= 26:
-                return True
-        else:
-            print("chromosome should be either X, Y, XY, MT or 0-26")
-            return False
-    except ValueError:
+    if chrom.upper() in CHROM_NAMES or (INT_RE.fullmatch(chrom) and 0 <= int(chrom) <= 26):
+        return True
+    else:
         return False
 
 #check the position detail is integer
 def valid_position(pos):
-    try:
-        int(pos)
+    if INT_RE.fullmatch(pos):
         return True
-    except ValueError:
-        print("position should be an integer")
+    else:
         return False
 
 #check the characters in genotype details only include 'A','C','T','G','D','I','-', or '0'
 def valid_genotype(geno):
-    geno_accepted = set('ACTGDI-0')
-    if all([i in geno_accepted for i in geno]):
+    if GENO_RE.fullmatch(geno):
         return True
     else:
-        print("genotype should be one of A, C, T, G, D, I, -, 0")
         return False
 
+#read the input file, check its content and write it to the output file with uniform format
+#raise ValueError with the reason if the input file is invalid
+def convert_23am(input_file, output_file):
+    with open(input_file, 'r') as inputf, open(output_file, 'w') as outf:
+        first_line = inputf.readline().strip() #extract the first line to detect the delimiter of the input file
+        if "\t" in first_line:
+            dialect = 'excel-tab'
+        elif "," in first_line:
+            dialect = 'excel'
+        else:
+            raise ValueError("file requires tab or comma delimiter")
+        
+        if "chromosome" in first_line.lower() or "position" in first_line.lower(): #if the first line is header, pass
+            pass
+        elif not re.search(r'[^#a-zA-Z0-9\s,-]', first_line): #if the first line is not header, check if it is valid information line
+            inputf.seek(0)
+        else: #if the first line is not header and not valid information line, raise error
+            raise ValueError("file first line should be either valid header or valid information line")
+            
+        reader = csv.reader(inputf, dialect=dialect) #read the input file with the detected delimiter
+        writer = csv.writer(outf, delimiter='\t') #write the output file with tab delimiter
+        writer.writerow(["# rsid", "chromosome", "position", "genotype"]) #write the header to the output file
+        #use for loop to read the input file line by line, lines starting with '#' are comments and skipped
+        #check the content and format of the input file is valid: correct number of columns, valid chromosome, position and genotype
+        #chromosome and genotype only have a few distinct values, so each distinct value is only checked once
+        #convert the different types of input files into files with uniform format: the genotype is 2 characters in 1 column, and the genotype is "--" if no genotype information
+        valid_chroms = set()
+        valid_genos = set()
+        for line in reader:
+            if not line or line[0].startswith('#'):
+                continue
+            if len(line) != 4 and len(line) !=5:
+                raise ValueError("expect 4 or 5 columns")
+            elif len(line) == 5:
+                rsid, chrom, pos, a1,a2 = line
+                geno = a1+a2
+            else:
+                rsid, chrom, pos, geno = line
+
+            if chrom not in valid_chroms:
+                if not valid_chromosome(chrom):
+                    raise ValueError(f"chromosome should be either X, Y, XY, MT or 0-26\nline {line} is invalid")
+                valid_chroms.add(chrom)
+            if not valid_position(pos):
+                raise ValueError(f"position should be an integer\nline {line} is invalid")
+            if geno not in valid_genos:
+                if not valid_genotype(geno):
+                    raise ValueError(f"genotype should be one of A, C, T, G, D, I, -, 0\nline {line} is invalid")
+                valid_genos.add(geno)
+            if geno == "00":
+                geno = "--"
+            writer.writerow([rsid, chrom, pos, geno])
+
+#validate and convert the input file to the output file, it can be called by other programs instead of running this script
+#return (True, "") on success and (False, error message) if the input file is invalid or can't be converted
+def validate_and_convert(input_file, output_file):
+    #check the input file exists and it's a file
+    if not Path(input_file).is_file():
+        return False, "check INPUT FILE exists and it's a file"
+    try:
+        convert_23am(input_file, output_file)
+    except (OSError, ValueError) as e:
+        #don't leave a partially written output file behind
+        Path(output_file).unlink(missing_ok=True)
+        return False, str(e)
+    return True, ""
+
 if __name__ == "__main__":
-    #check the input arguments have correct number and the input file exists and it's a file
+    #check the input arguments have correct number
     if len(sys.argv) != 3:
         print("wrong parameter number. Usage: python valid_23am.py input_file output_file")
         sys.exit(1)
-    if not Path(sys.argv[1]).exists() or not Path(sys.argv[1]).is_file():
-        print(f"check INPUT FILE exists and it's a file")
-        raise FileNotFoundError
 
     input_file = sys.argv[1] #input_file
     output_file = sys.argv[2] #output_file
 
-    try:
-        with open(input_file, 'r') as inputf, open(output_file, 'w') as outf:
-            first_line = inputf.readline().strip() #extract the first line to detect the delimiter of the input file
-            if "\t" in first_line:
-                dialect = 'excel-tab'
-            elif "," in first_line:
-                dialect = 'excel'
-            else:
-                print("file requires tab or comma delimiter")
-                raise ValueError           
-            
-            if "chromosome" in first_line.lower() or "position" in first_line.lower(): #if the first line is header, pass
-                pass
-            elif not re.search(r'[^#a-zA-Z0-9\s,-]', first_line): #if the first line is not header, check if it is valid information line
-                inputf.seek(0)
-            else: #if the first line is not header and not valid information line, raise error
-                print("file first line should be either valid header or valid information line")
-                raise ValueError
-                
-            reader = csv.reader(inputf, dialect=dialect) #read the input file with the detected delimiter
-            writer = csv.writer(outf, delimiter='\t') #write the output file with tab delimiter
-            writer.writerow(["# rsid", "chromosome", "position", "genotype"]) #write the header to the output file
-            #use for loop to read the input file line by line
-            #check the content and format of the input file is valid: correct number of columns, valid chromosome, position and genotype
-            #convert the different types of input files into files with uniform format: the genotype is 2 characters in 1 column, and the genotype is "--" if no genotype information
-            for line in reader:
-                if not line:
-                    continue
-                if len(line) != 4 and len(line) !=5:
-                    print("expect 4 or 5 columns")
-                    raise ValueError
-                elif len(line) == 5:
-                    rsid, chrom, pos, a1,a2 = line
-                    geno = a1+a2
-                else:
-                    rsid, chrom, pos, geno = line
-
-                if not valid_chromosome(chrom) or not valid_position(pos) or not valid_genotype(geno):
-                    print(f"line {line} is invalid")
-                    raise ValueError(f"Invalid data found: {line}")
-                if geno == "00":
-                    geno = "--"
-                writer.writerow([rsid, chrom, pos, geno])
-
-    except FileNotFoundError:
-        sys.exit(1)
-    except ValueError:
+    ok, error_msg = validate_and_convert(input_file, output_file)
+    if not ok:
+        print(error_msg)
         sys.exit(1)